@@ -1,41 +1,128 @@
-import json
+import asyncio
+import hashlib
 from copy import deepcopy
-from typing import Any
+from typing import Any, Optional
 
+import orjson
 from aidial_client import AsyncDial
 from aidial_sdk.chat_completion import Role, Choice, Request, Message, Stage
 from pydantic import StrictStr
 
+from task.cache import TTLCache
+from task.clients import get_dial, get_http_client
 from task.coordination.gpa import GPAGateway
 from task.coordination.ums_agent import UMSAgentGateway
+from task.coordination_parser import CoordinationStreamParser
 from task.logging_config import get_logger
 from task.models import CoordinationRequest, AgentName
-from task.prompts import COORDINATION_REQUEST_SYSTEM_PROMPT, FINAL_RESPONSE_SYSTEM_PROMPT
+from task.prompts import (
+    COORDINATION_AFFINITY,
+    COORDINATION_PREFIX_BYTES,
+    FINAL_AFFINITY,
+    build_coordination_messages,
+    build_final_response_messages
+)
+from task.routing import pick_endpoint
+from task.single_flight import SingleFlight
 from task.stage_util import StageProcessor
 
 logger = get_logger(__name__)
 
+# Coordination request schema doesn't change at runtime, so it's built once on import
+_COORDINATION_SCHEMA = CoordinationRequest.model_json_schema()
+_COORDINATION_EXTRA_BODY = {
+    "response_format": {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "response",
+            "schema": _COORDINATION_SCHEMA
+        }
+    }
+}
+# Same with `prompt_cache_key`, it routes requests with the same prompt prefix to the same replica (its prompt cache)
+_COORDINATION_EXTRA_BODY_WITH_CACHE_KEY = {**_COORDINATION_EXTRA_BODY, "prompt_cache_key": COORDINATION_AFFINITY}
+_FINAL_RESPONSE_EXTRA_BODY_WITH_CACHE_KEY = {"prompt_cache_key": FINAL_AFFINITY}
+
+# Shared between requests, concurrent classifier calls with identical input share one upstream call (no batching)
+_coordination_flights = SingleFlight()
+# Exact-match cache of classifier results keyed by the same classifier input hash
+_coordination_cache: TTLCache[CoordinationRequest] = TTLCache(maxsize=10_000, ttl=600)
+
+
+# Hash state after the static coordination prefix, each key continues from its copy instead of rehashing the prompt
+_COORDINATION_KEY_BASE = hashlib.blake2b(COORDINATION_PREFIX_BYTES)
+
+
+def _coordination_key(deployment_name: str, messages: list[dict[str, Any]]) -> str:
+    """Key of classifier input, messages are the conversation messages without system prompt"""
+    key = _COORDINATION_KEY_BASE.copy()
+    key.update(orjson.dumps([deployment_name, messages], default=str))
+    return key.hexdigest()
+
 
 class MASCoordinator:
 
-    def __init__(self, endpoint: str, deployment_name: str, ums_agent_endpoint: str, gpa_agent_endpoint: str):
+    def __init__(
+            self,
+            endpoint: str,
+            deployment_name: str,
+            ums_agent_endpoints: list[str],
+            gpa_agent_endpoints: list[str],
+            prompt_cache_control: bool = False,
+            prompt_cache_key: bool = False
+    ):
         self.endpoint = endpoint
         self.deployment_name = deployment_name
-        self.ums_agent_endpoint = ums_agent_endpoint
-        self.gpa_agent_endpoint = gpa_agent_endpoint
-
-    async def handle_request(self, choice: Choice, request: Request, api_key: str) -> Message:
-        # Create AsyncDial client with API key
-        logger.info(f"Creating AsyncDial client with endpoint: {self.endpoint}, api_key: {api_key[:10] if len(api_key) > 10 else api_key}")
-        logger.info(f"Request has {len(request.messages)} messages")
-        client = AsyncDial(base_url=self.endpoint, api_version='2025-01-01-preview', api_key=api_key)
+        self.ums_agent_endpoints = ums_agent_endpoints
+        self.gpa_agent_endpoints = gpa_agent_endpoints
+        # Send system prompts as blocks with cache markers, needed for prompt caching with Anthropic models
+        self.prompt_cache_control = prompt_cache_control
+        # Send `prompt_cache_key`, off by default since not every deployment accepts unknown body fields
+        self.coordination_extra_body = (
+            _COORDINATION_EXTRA_BODY_WITH_CACHE_KEY if prompt_cache_key else _COORDINATION_EXTRA_BODY
+        )
+        self.final_response_extra_body = _FINAL_RESPONSE_EXTRA_BODY_WITH_CACHE_KEY if prompt_cache_key else None
+
+    async def handle_request(self, choice: Choice, request: Request, api_key: str, user_api_key: str) -> Message:
+        # Get shared AsyncDial client for API key
+        logger.info("Using AsyncDial client with endpoint: %s, api_key: %.10s", self.endpoint, api_key)
+        logger.info("Request has %d messages", len(request.messages))
+        client = get_dial(self.endpoint, api_key)
+        
+        # Agent replicas are picked by conversation id, so the whole conversation sticks to the same replicas
+        conversation_id = request.headers.get('x-conversation-id') if request.headers else None
+        ums_gateway = UMSAgentGateway(pick_endpoint(conversation_id, self.ums_agent_endpoints), get_http_client())
+        gpa_gateway = GPAGateway(pick_endpoint(conversation_id, self.gpa_agent_endpoints))
         
         # Open stage for Coordination Request
         coordination_stage = StageProcessor.open_stage(choice, "Coordination Request")
         
+        # Classifier results are cached by the full classifier input, so repeated requests skip the LLM call
+        conversation_messages = self.__prepare_messages(request)
+        coordination_key = _coordination_key(self.deployment_name, conversation_messages)
+        messages = build_coordination_messages(conversation_messages, self.prompt_cache_control)
+        coordination_request = _coordination_cache.get(coordination_key)
+        ums_conversation_task: Optional[asyncio.Task[str]] = None
+        
         try:
-            # Prepare coordination request
-            coordination_request = await self.__prepare_coordination_request(client, request)
+            if coordination_request is None:
+                # Run the classifier in background, parser resolves agent name as soon as it appears in the stream.
+                # Identical classifier requests that are already in flight are joined instead of being sent again
+                flight = _coordination_flights.submit(
+                    coordination_key,
+                    lambda parser: self.__prepare_coordination_request(client, messages, parser, coordination_key)
+                )
+                await asyncio.wait({flight.parser.agent_name, flight.task}, return_when=asyncio.FIRST_COMPLETED)
+                
+                # Overlap UMS conversation lookup/creation with the rest of the classifier stream
+                agent_name_future = flight.parser.agent_name
+                if agent_name_future.done() and not agent_name_future.cancelled() and agent_name_future.result() == AgentName.UMS:
+                    ums_conversation_task = asyncio.create_task(ums_gateway.resolve_conversation_id(request))
+                
+                # Prepare coordination request (shielded, the classifier call can be shared with other requests)
+                coordination_request = await asyncio.shield(flight.task)
+            else:
+                logger.info("Coordination request cache hit: %s", coordination_request.agent_name)
             
             # Add to the stage generated coordination request and close the stage
             # Note: Stages don't have append method, we'll just close it since the routing info
@@ -50,69 +137,68 @@ class MASCoordinator:
                     choice,
                     agent_stage,
                     request,
-                    api_key
+                    user_api_key,
+                    ums_gateway,
+                    gpa_gateway,
+                    ums_conversation_task
                 )
-                logger.info(f"Agent message received - Content length: {len(agent_message.content) if agent_message.content else 0}")
-                logger.info(f"Agent message content preview: {agent_message.content[:200] if agent_message.content else 'None'}...")
-                logger.info(f"Agent message has custom_content: {agent_message.custom_content is not None}")
+                logger.info("Agent message received - Content length: %d", len(agent_message.content or ""))
+                logger.debug("Agent message content preview: %.200s...", agent_message.content)
+                logger.info("Agent message has custom_content: %s", agent_message.custom_content is not None)
             finally:
                 StageProcessor.close_stage_safely(agent_stage)
             
             # The agent message is already written to the agent stage and contains the complete response
             # In DIAL SDK, content written to stages during execution is what gets displayed
             # We return the message for consistency, but the actual display comes from what was written to stages
-            logger.info(f"Returning agent message - Role: {agent_message.role}, Content length: {len(agent_message.content) if agent_message.content else 0}")
+            logger.info("Returning agent message - Role: %s, Content length: %d", agent_message.role, len(agent_message.content or ""))
             return agent_message
         except Exception as e:
             StageProcessor.close_stage_safely(coordination_stage)
             raise
+        finally:
+            if ums_conversation_task is not None:
+                if not ums_conversation_task.done():
+                    ums_conversation_task.cancel()
+                # Retrieve the outcome, so failure of unused lookup isn't logged as "Task exception was never retrieved"
+                ums_conversation_task.add_done_callback(lambda task: task.cancelled() or task.exception())
 
-    async def __prepare_coordination_request(self, client: AsyncDial, request: Request) -> CoordinationRequest:
-        messages = self.__prepare_messages(request, COORDINATION_REQUEST_SYSTEM_PROMPT)
-        
-        extra_body = {
-            "response_format": {
-                "type": "json_schema",
-                "json_schema": {
-                    "name": "response",
-                    "schema": CoordinationRequest.model_json_schema()
-                }
-            }
-        }
-        
+    async def __prepare_coordination_request(
+            self,
+            client: AsyncDial,
+            messages: list[dict[str, Any]],
+            parser: CoordinationStreamParser,
+            cache_key: str
+    ) -> CoordinationRequest:
         try:
-            response = await client.chat.completions.create(
+            stream = await client.chat.completions.create(
                 deployment_name=self.deployment_name,
                 messages=messages,
-                extra_body=extra_body
+                stream=True,
+                extra_body=self.coordination_extra_body
             )
         except Exception as e:
-            logger.error(f"Error calling DIAL endpoint: {e}")
-            logger.error(f"Endpoint: {self.endpoint}, Deployment: {self.deployment_name}")
+            logger.error("Error calling DIAL endpoint: %s", e)
+            logger.error("Endpoint: %s, Deployment: %s", self.endpoint, self.deployment_name)
             raise
         
-        content = response.choices[0].message.content
-        result_dict = json.loads(content)
-        coordination_request = CoordinationRequest.model_validate(result_dict)
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parser.feed(chunk.choices[0].delta.content)
         
+        coordination_request = parser.result()
+        _coordination_cache.set(cache_key, coordination_request)
         return coordination_request
 
-    def __prepare_messages(self, request: Request, system_prompt: str) -> list[dict[str, Any]]:
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        for message in request.messages:
-            if message.role == Role.USER and message.custom_content:
-                # User message with custom content - add message with content, skip custom_content
-                messages.append({
-                    "role": "user",
-                    "content": message.content
-                })
-            else:
-                # Regular message - append as dict with excluded none fields
-                msg_dict = message.dict(exclude_none=True)
-                messages.append(msg_dict)
-        
-        return messages
+    def __prepare_messages(self, request: Request) -> list[dict[str, Any]]:
+        return [
+            # User message with custom content - add message with content, skip custom_content
+            {"role": "user", "content": message.content}
+            if message.role == Role.USER and message.custom_content
+            # Regular message - append as dict with excluded none fields
+            else message.model_dump(exclude_none=True)
+            for message in request.messages
+        ]
 
     async def __handle_coordination_request(
             self,
@@ -120,29 +206,27 @@ class MASCoordinator:
             choice: Choice,
             stage: Stage,
             request: Request,
-            api_key: str
+            user_api_key: str,
+            ums_gateway: UMSAgentGateway,
+            gpa_gateway: GPAGateway,
+            ums_conversation_task: Optional[asyncio.Task[str]] = None
     ) -> Message:
         if coordination_request.agent_name == AgentName.UMS:
-            ums_gateway = UMSAgentGateway(self.ums_agent_endpoint)
             return await ums_gateway.response(
                 choice=choice,
                 stage=stage,
                 request=request,
-                additional_instructions=coordination_request.additional_instructions
+                additional_instructions=coordination_request.additional_instructions,
+                conversation_id=await ums_conversation_task if ums_conversation_task else None
             )
         elif coordination_request.agent_name == AgentName.GPA:
-            gpa_gateway = GPAGateway(self.gpa_agent_endpoint)
-            # Get API key from request headers for GPA service (GPA service uses the same API key as the user provides)
-            gpa_api_key = request.headers.get('Api-Key') or request.headers.get('api-key') if request.headers else None
-            if not gpa_api_key:
-                # Fallback to the api_key parameter if headers don't have it
-                gpa_api_key = api_key
+            # GPA service uses the same API key as the user provides
             return await gpa_gateway.response(
                 choice=choice,
                 stage=stage,
                 request=request,
                 additional_instructions=coordination_request.additional_instructions,
-                api_key=gpa_api_key
+                api_key=user_api_key
             )
         else:
             raise ValueError(f"Unknown agent name: {coordination_request.agent_name}")
@@ -153,20 +237,17 @@ class MASCoordinator:
             request: Request,
             agent_message: Message
     ) -> Message:
-        messages = self.__prepare_messages(request, FINAL_RESPONSE_SYSTEM_PROMPT)
-        
-        # Augment with agent response as context and user request
-        last_user_message = request.messages[-1].content
-        augmented_content = f"Context from agent:\n{agent_message.content}\n\nUser request: {last_user_message}"
-
-        # Update last message content with augmented prompt
-        messages[-1]["content"] = augmented_content
+        # Augment last message with agent response as context and user request
+        messages = build_final_response_messages(
+            self.__prepare_messages(request), agent_message.content, self.prompt_cache_control
+        )
 
         # Call LLM with streaming
         stream = await client.chat.completions.create(
             deployment_name=self.deployment_name,
             messages=messages,
-            stream=True
+            stream=True,
+            extra_body=self.final_response_extra_body
         )
 
         # Stream final response content directly to the choice
@@ -190,7 +271,7 @@ class MASCoordinator:
                         if delta.content:
                             content += delta.content
         except Exception as e:
-            logger.warning(f"Could not write to choice directly: {e}, collecting content instead")
+            logger.warning("Could not write to choice directly: %s, collecting content instead", e)
             # Fallback: collect all content
             async for chunk in stream:
                 if chunk.choices and len(chunk.choices) > 0:
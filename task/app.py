@@ -1,18 +1,32 @@
 import os
+from contextlib import asynccontextmanager
 
 import uvicorn
 from aidial_sdk import DIALApp
 from aidial_sdk.chat_completion import ChatCompletion, Request, Response
 
 from task.agent import MASCoordinator
+from task.clients import close_clients
 from task.logging_config import setup_logging, get_logger
+from task.routing import parse_endpoints
 
 DIAL_ENDPOINT = os.getenv('DIAL_ENDPOINT', "http://localhost:8080")
 DEPLOYMENT_NAME = os.getenv('DEPLOYMENT_NAME', 'gpt-4o')
 UMS_AGENT_ENDPOINT = os.getenv('UMS_AGENT_ENDPOINT', "http://localhost:8042")
 GPA_AGENT_ENDPOINT = os.getenv('GPA_AGENT_ENDPOINT', "http://localhost:8052")
+# Comma-separated lists of agent replicas, conversations are pinned to replicas by conversation id
+UMS_AGENT_ENDPOINTS = parse_endpoints(os.getenv('UMS_AGENT_ENDPOINTS', UMS_AGENT_ENDPOINT))
+GPA_AGENT_ENDPOINTS = parse_endpoints(os.getenv('GPA_AGENT_ENDPOINTS', GPA_AGENT_ENDPOINT))
+if not UMS_AGENT_ENDPOINTS:
+    raise ValueError("UMS_AGENT_ENDPOINTS must contain at least one endpoint")
+if not GPA_AGENT_ENDPOINTS:
+    raise ValueError("GPA_AGENT_ENDPOINTS must contain at least one endpoint")
 DIAL_API_KEY = os.getenv('DIAL_API_KEY', 'dial_api_key')
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+# Mark system prompts with cache_control blocks (for Anthropic models behind DIAL)
+PROMPT_CACHE_CONTROL = os.getenv('PROMPT_CACHE_CONTROL', 'false').lower() == 'true'
+# Send prompt_cache_key with LLM calls (for deployments that accept it, e.g. OpenAI)
+PROMPT_CACHE_KEY = os.getenv('PROMPT_CACHE_KEY', 'false').lower() == 'true'
 
 setup_logging(log_level=LOG_LEVEL)
 logger = get_logger(__name__)
@@ -29,20 +43,32 @@ class MASCoordinatorApplication(ChatCompletion):
         # We always use 'dial_api_key' for internal calls to the core service, regardless of
         # what API key the user sends in the request header
         api_key = 'dial_api_key'  # Always use dial_api_key for core service calls
-        logger.info(f"Using API key: {api_key} for core service calls")
-        logger.info(f"DIAL_ENDPOINT: {DIAL_ENDPOINT}, DEPLOYMENT_NAME: {DEPLOYMENT_NAME}")
+        logger.info("Using API key: %s for core service calls", api_key)
+        # API key the user sent with the request, extracted once and forwarded to GPA
+        # (DIAL SDK takes it out of request headers into request.api_key)
+        user_api_key = request.api_key
+        logger.info("DIAL_ENDPOINT: %s, DEPLOYMENT_NAME: %s", DIAL_ENDPOINT, DEPLOYMENT_NAME)
         # Create MASCoordinator and handle request
         coordinator = MASCoordinator(
             endpoint=DIAL_ENDPOINT,
             deployment_name=DEPLOYMENT_NAME,
-            ums_agent_endpoint=UMS_AGENT_ENDPOINT,
-            gpa_agent_endpoint=GPA_AGENT_ENDPOINT
+            ums_agent_endpoints=UMS_AGENT_ENDPOINTS,
+            gpa_agent_endpoints=GPA_AGENT_ENDPOINTS,
+            prompt_cache_control=PROMPT_CACHE_CONTROL,
+            prompt_cache_key=PROMPT_CACHE_KEY
         )
-        await coordinator.handle_request(choice, request, api_key)
+        await coordinator.handle_request(choice, request, api_key, user_api_key)
+
+
+@asynccontextmanager
+async def lifespan(_app: DIALApp):
+    yield
+    # Close shared HTTP connections on shutdown
+    await close_clients()
 
 
 # Create DIALApp
-app = DIALApp()
+app = DIALApp(lifespan=lifespan)
 
 # Create MASCoordinatorApplication
 agent_app = MASCoordinatorApplication()
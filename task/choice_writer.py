@@ -0,0 +1,64 @@
+import asyncio
+import contextlib
+from time import monotonic
+from typing import Optional
+
+from aidial_sdk.chat_completion import Choice
+
+from task.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+
+class ChoiceWriter:
+    """
+    Coalesces streamed content deltas into bigger choice chunks.
+
+    Buffered content is flushed when it reaches `max_size` characters or when `max_delay` seconds
+    passed since the last flush. Use as async context manager, so idle tail is flushed by background
+    task and everything left is flushed on exit.
+    """
+
+    def __init__(self, choice: Choice, max_size: int = 512, max_delay: float = 0.02):
+        self.choice = choice
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.buf: list[str] = []
+        self.buffered_size = 0
+        self.last_flush = monotonic()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def write(self, content: str) -> None:
+        self.buf.append(content)
+        self.buffered_size += len(content)
+        if self.buffered_size >= self.max_size or monotonic() - self.last_flush >= self.max_delay:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.buf:
+            # Single guard for all writes, a failed write must not break the stream processing
+            try:
+                self.choice.append_content("".join(self.buf))
+            except Exception as e:
+                logger.warning("Could not append to choice: %s", e)
+            self.buf.clear()
+            self.buffered_size = 0
+        self.last_flush = monotonic()
+
+    async def periodic_flush(self) -> None:
+        while True:
+            await asyncio.sleep(self.max_delay)
+            if self.buf and monotonic() - self.last_flush >= self.max_delay:
+                self.flush()
+
+    async def __aenter__(self) -> "ChoiceWriter":
+        self._flush_task = asyncio.create_task(self.periodic_flush())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        if self._flush_task:
+            self._flush_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._flush_task
+            self._flush_task = None
+        self.flush()
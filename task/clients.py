@@ -0,0 +1,59 @@
+from functools import lru_cache
+from typing import Optional
+
+import httpx
+from aidial_client import AsyncDial, AuthType
+from aidial_client._http_client import AsyncHTTPClient
+
+API_VERSION = '2025-01-01-preview'
+
+_MAX_RETRIES = 2
+_TIMEOUT = httpx.Timeout(300.0, connect=10.0)
+_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=100)
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Shared HTTP client, keeps connections to DIAL Core and agents alive between requests"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(limits=_LIMITS, timeout=_TIMEOUT, http2=True)
+    return _http_client
+
+
+def create_dial(endpoint: str, api_key: str) -> AsyncDial:
+    """
+    New AsyncDial client on top of the shared HTTP client. Use it for per-request keys (e.g. user API key),
+    it is cheap to create and must not be cached, so secrets don't outlive the request
+    """
+    return AsyncDial(
+        base_url=endpoint,
+        api_version=API_VERSION,
+        api_key=api_key,
+        max_retries=_MAX_RETRIES,
+        timeout=_TIMEOUT,
+        http_client=AsyncHTTPClient(
+            base_url=endpoint,
+            auth_value=api_key,
+            auth_type=AuthType.API_KEY,
+            max_retries=_MAX_RETRIES,
+            timeout=_TIMEOUT,
+            internal_http_client=get_http_client()
+        )
+    )
+
+
+@lru_cache(maxsize=8)
+def get_dial(endpoint: str, api_key: str) -> AsyncDial:
+    """AsyncDial client for static service keys, cached per (endpoint, api_key)"""
+    return create_dial(endpoint, api_key)
+
+
+async def close_clients() -> None:
+    """Close the shared HTTP client and drop all cached AsyncDial clients bound to it"""
+    global _http_client
+    get_dial.cache_clear()
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
@@ -1,15 +1,84 @@
-from copy import deepcopy
-from typing import Optional, Any
+from dataclasses import dataclass, field
+from typing import Optional, Any, Callable
 
-from aidial_client import AsyncDial
 from aidial_sdk.chat_completion import Role, Choice, Request, Message, CustomContent, Stage, Attachment
 from pydantic import StrictStr
 
+from task.choice_writer import ChoiceWriter
+from task.clients import create_dial
+from task.logging_config import get_logger
 from task.stage_util import StageProcessor
 
 _IS_GPA = "is_gpa"
 _GPA_MESSAGES = "gpa_messages"
 
+logger = get_logger(__name__)
+
+
+def _restore_gpa_turn(prev_message: Optional[Message], message: Message) -> list[dict[str, Any]]:
+    """Restore GPA turn from assistant message with GPA state: previous (user) message and assistant message"""
+    if message.role != Role.ASSISTANT or not message.custom_content or not message.custom_content.state:
+        return []
+    state = message.custom_content.state
+    if not isinstance(state, dict) or state.get(_IS_GPA) is not True:
+        return []
+    
+    turn = []
+    if prev_message is not None:
+        turn.append(prev_message.model_dump(exclude_none=True))
+    # Restore assistant message with state from _GPA_MESSAGES
+    if _GPA_MESSAGES in state:
+        msg_dict = message.model_dump(exclude_none=True)
+        msg_dict.setdefault('custom_content', {})['state'] = state[_GPA_MESSAGES]
+        turn.append(msg_dict)
+    return turn
+
+
+def _dict_converter(value: Any) -> Callable[[Any], dict[str, Any]]:
+    """Pick how to convert streamed custom content (and alike) to dict without None fields"""
+    if hasattr(value, 'model_dump'):
+        return lambda v: v.model_dump(exclude_none=True)
+    if hasattr(value, 'dict'):
+        return lambda v: v.dict(exclude_none=True)
+    if hasattr(value, '__dict__'):
+        return lambda v: {k: val for k, val in v.__dict__.items() if val is not None}
+    return lambda v: {}
+
+
+@dataclass
+class _StageState:
+    """Propagated GPA stage and what was already propagated to it"""
+    stage: Stage
+    attachment_keys: set[tuple] = field(default_factory=set)
+    closed: bool = False
+
+
+def _attachment_key(attachment: Any) -> tuple:
+    if isinstance(attachment, dict):
+        return attachment.get('url'), attachment.get('data'), attachment.get('title')
+    return getattr(attachment, 'url', None), getattr(attachment, 'data', None), getattr(attachment, 'title', None)
+
+
+_ATTACHMENT_FIELDS = frozenset(Attachment.__fields__)
+
+
+def _to_attachment(attachment: Any, trusted: bool = False) -> Attachment:
+    """
+    Convert streamed attachment to SDK Attachment. `trusted` dicts were dumped from validated aidial_client models
+    and skip validation (unless they carry both url and data), everything else (e.g. raw stage attachments from
+    upstream JSON) is validated
+    """
+    if isinstance(attachment, Attachment):
+        return attachment
+    if isinstance(attachment, dict):
+        # Attachment allows extra fields, keep unknown upstream keys out of our response
+        fields = {key: value for key, value in attachment.items() if key in _ATTACHMENT_FIELDS}
+        # aidial_client accepts both url and data at once, SDK doesn't, such attachments go through validation
+        if trusted and not (fields.get('url') is not None and fields.get('data') is not None):
+            return Attachment.construct(**fields)
+        return Attachment(**fields)
+    return Attachment(**_dict_converter(attachment)(attachment))
+
 
 class GPAGateway:
 
@@ -22,18 +91,14 @@ class GPAGateway:
             stage: Stage,
             request: Request,
             additional_instructions: Optional[str],
-            api_key: Optional[str] = None
+            api_key: str
     ) -> Message:
-        # Create AsyncDial client
+        # AsyncDial client per request (user API key changes with every request), connections are shared
         # The endpoint should be the GPA service endpoint (default: http://localhost:8052)
-        # Get API key from request headers if not provided
-        if not api_key:
-            api_key = request.headers.get('Api-Key') or request.headers.get('api-key') if request.headers else None
-        
         if not api_key:
-            raise ValueError("API key is required for GPA gateway. Provide it via api_key parameter or Api-Key header.")
+            raise ValueError("API key is required for GPA gateway.")
         
-        client = AsyncDial(base_url=self.endpoint, api_version='2025-01-01-preview', api_key=api_key)
+        client = create_dial(self.endpoint, api_key)
         
         # Prepare messages for GPA
         messages = self.__prepare_gpa_messages(request, additional_instructions)
@@ -54,115 +119,53 @@ class GPAGateway:
         # Variables for collecting response
         content = ""
         result_custom_content = CustomContent(attachments=[], state=None)
-        stages_map: dict[int, Stage] = {}
+        stages_map: dict[int, _StageState] = {}
         chunk_count = 0
-        
-        from task.logging_config import get_logger
-        logger = get_logger(__name__)
+        to_dict: Optional[Callable[[Any], dict[str, Any]]] = None
         
         # Process streaming response
-        async for chunk in stream:
-            if chunk.choices and len(chunk.choices) > 0:
-                delta = chunk.choices[0].delta
+        async with ChoiceWriter(choice) as writer:
+            async for chunk in stream:
+                if chunk.choices and len(chunk.choices) > 0:
+                    delta = chunk.choices[0].delta
                 
-                # Handle content
-                if delta.content:
-                    content += delta.content
-                    chunk_count += 1
-                    # Append to choice - this is the correct way to write content in DIAL SDK
-                    try:
-                        choice.append_content(delta.content)
-                    except Exception as e:
-                        logger.warning(f"Could not append to choice: {e}")
+                    # Handle content
+                    if delta.content:
+                        content += delta.content
+                        chunk_count += 1
+                        # Append to choice through writer, it coalesces small deltas into bigger chunks
+                        writer.write(delta.content)
                 
-                # Handle custom_content
-                if delta.custom_content:
-                    # Convert custom_content to dict
-                    if hasattr(delta.custom_content, 'dict'):
-                        custom_content_dict = delta.custom_content.dict(exclude_none=True)
-                    elif hasattr(delta.custom_content, '__dict__'):
-                        custom_content_dict = {k: v for k, v in delta.custom_content.__dict__.items() if v is not None}
-                    else:
-                        custom_content_dict = {}
+                    # Handle custom_content
+                    if delta.custom_content:
+                        # Convert custom_content to dict, converter is resolved once since the type is stable within stream
+                        if to_dict is None:
+                            to_dict = _dict_converter(delta.custom_content)
+                        custom_content_dict = to_dict(delta.custom_content)
                     
-                    # Handle attachments
-                    if 'attachments' in custom_content_dict and custom_content_dict['attachments']:
-                        for attachment in custom_content_dict['attachments']:
-                            if hasattr(attachment, 'dict'):
-                                result_custom_content.attachments.append(
-                                    Attachment(**attachment.dict(exclude_none=True))
-                                )
-                            else:
-                                result_custom_content.attachments.append(
-                                    Attachment(**attachment if isinstance(attachment, dict) else attachment.__dict__)
-                                )
+                        # Handle attachments
+                        result_custom_content.attachments.extend(
+                            _to_attachment(attachment, trusted=True) for attachment in custom_content_dict.get('attachments') or ()
+                        )
                     
-                    # Handle state
-                    if 'state' in custom_content_dict and custom_content_dict['state']:
-                        if result_custom_content.state is None:
-                            result_custom_content.state = {}
-                        if isinstance(custom_content_dict['state'], dict):
-                            result_custom_content.state.update(custom_content_dict['state'])
+                        # Handle state
+                        if 'state' in custom_content_dict and custom_content_dict['state']:
+                            if result_custom_content.state is None:
+                                result_custom_content.state = {}
+                            if isinstance(custom_content_dict['state'], dict):
+                                result_custom_content.state.update(custom_content_dict['state'])
                     
-                    # Handle stages propagation
-                    if 'stages' in custom_content_dict:
-                        for stg in custom_content_dict['stages']:
+                        # Handle stages propagation
+                        for stg in custom_content_dict.get('stages') or ():
                             if 'index' in stg:
-                                idx = stg['index']
-                                if idx in stages_map:
-                                    # Update existing stage
-                                    existing_stage = stages_map[idx]
-                                    if 'content' in stg:
-                                        try:
-                                            # Write content to choice, not stage
-                                            choice.append_content(stg['content'])
-                                        except:
-                                            pass
-                                    if 'attachments' in stg:
-                                        for attachment in stg['attachments']:
-                                            try:
-                                                if hasattr(attachment, 'dict'):
-                                                    existing_stage.add_attachment(
-                                                        Attachment(**attachment.dict(exclude_none=True))
-                                                    )
-                                                else:
-                                                    existing_stage.add_attachment(
-                                                        Attachment(**attachment if isinstance(attachment, dict) else attachment.__dict__)
-                                                    )
-                                            except:
-                                                pass
-                                    if 'status' in stg and stg['status'] == 'completed':
-                                        StageProcessor.close_stage_safely(existing_stage)
-                                else:
-                                    # Create new stage
-                                    new_stage = StageProcessor.open_stage(choice, stg.get('name'))
-                                    stages_map[idx] = new_stage
-                                    if 'content' in stg:
-                                        try:
-                                            # Write content to choice, not stage
-                                            choice.append_content(stg['content'])
-                                        except:
-                                            pass
-                                    if 'attachments' in stg:
-                                        for attachment in stg['attachments']:
-                                            try:
-                                                if hasattr(attachment, 'dict'):
-                                                    new_stage.add_attachment(
-                                                        Attachment(**attachment.dict(exclude_none=True))
-                                                    )
-                                                else:
-                                                    new_stage.add_attachment(
-                                                        Attachment(**attachment if isinstance(attachment, dict) else attachment.__dict__)
-                                                    )
-                                            except:
-                                                pass
+                                self.__propagate_stage(choice, writer, stages_map, stg)
         
         # Save GPA conversation state to choice state
         if result_custom_content.state:
             choice.set_state({_IS_GPA: True, _GPA_MESSAGES: result_custom_content.state})
         
-        logger.info(f"GPA response collected - Total chunks: {chunk_count}, Content length: {len(content)}")
-        logger.info(f"GPA response content preview: {content[:200] if content else 'None'}...")
+        logger.info("GPA response collected - Total chunks: %d, Content length: %d", chunk_count, len(content))
+        logger.debug("GPA response content preview: %.200s...", content)
         
         # Return assistant message with content and custom_content
         # Custom content (attachments, state) should be part of the Message, not set on Choice
@@ -175,39 +178,47 @@ class GPAGateway:
         else:
             return Message(role=Role.ASSISTANT, content=content)
 
-    def __prepare_gpa_messages(self, request: Request, additional_instructions: Optional[str]) -> list[dict[str, Any]]:
-        res_messages = []
+    @staticmethod
+    def __propagate_stage(choice: Choice, writer: ChoiceWriter, stages_map: dict[int, _StageState], stg: dict[str, Any]) -> None:
+        idx = stg['index']
+        stage_state = stages_map.get(idx)
+        if stage_state is None:
+            # Create new stage
+            stage_state = stages_map[idx] = _StageState(StageProcessor.open_stage(choice, stg.get('name')))
+        if stage_state.closed:
+            # Updates after completion are repeats of what was already propagated
+            return
         
-        # Iterate through request messages
-        for idx in range(len(request.messages)):
-            message = request.messages[idx]
-            
-            if message.role == Role.ASSISTANT:
-                # Check if it has custom content with state
-                if message.custom_content and message.custom_content.state:
-                    state = message.custom_content.state
-                    if isinstance(state, dict) and state.get(_IS_GPA) is True:
-                        # Add user message (previous message)
-                        if idx > 0:
-                            user_msg = request.messages[idx - 1]
-                            res_messages.append(user_msg.dict(exclude_none=True))
-                        
-                        # Restore assistant message with state from _GPA_MESSAGES
-                        assistant_msg = deepcopy(message)
-                        if _GPA_MESSAGES in state:
-                            # Create new message with restored state
-                            msg_dict = assistant_msg.dict(exclude_none=True)
-                            if 'custom_content' not in msg_dict:
-                                msg_dict['custom_content'] = {}
-                            if 'state' not in msg_dict.get('custom_content', {}):
-                                msg_dict['custom_content']['state'] = {}
-                            msg_dict['custom_content']['state'] = state[_GPA_MESSAGES]
-                            res_messages.append(msg_dict)
+        if 'content' in stg:
+            # Stage content comes as delta, write content to choice, not stage
+            writer.write(stg['content'])
+        
+        for attachment in stg.get('attachments') or ():
+            key = _attachment_key(attachment)
+            if key in stage_state.attachment_keys:
+                continue
+            stage_state.attachment_keys.add(key)
+            try:
+                stage_state.stage.add_attachment(_to_attachment(attachment))
+            except Exception:
+                pass
+        
+        if stg.get('status') == 'completed':
+            StageProcessor.close_stage_safely(stage_state.stage)
+            stage_state.closed = True
+
+    def __prepare_gpa_messages(self, request: Request, additional_instructions: Optional[str]) -> list[dict[str, Any]]:
+        # Restore previous GPA turns, every message is paired with the one before it
+        res_messages = [
+            msg_dict
+            for prev_message, message in zip([None, *request.messages], request.messages)
+            for msg_dict in _restore_gpa_turn(prev_message, message)
+        ]
         
         # Add last message (user message)
         if request.messages:
             last_msg = request.messages[-1]
-            last_msg_dict = last_msg.dict(exclude_none=True)
+            last_msg_dict = last_msg.model_dump(exclude_none=True)
             
             # Augment with additional instructions if present
             if additional_instructions:
@@ -1,34 +1,42 @@
-import json
-from typing import Optional
+import uuid
+from typing import AsyncIterator, Optional
 
 import httpx
+import orjson
 from aidial_sdk.chat_completion import Role, Request, Message, Stage, Choice
 from pydantic import StrictStr
 
+from task.choice_writer import ChoiceWriter
+from task.logging_config import get_logger
+
 
 _UMS_CONVERSATION_ID = "ums_conversation_id"
 
+# UMS endpoints that answered 404 to a chat on a client-generated conversation id, they need explicit creation
+_NO_AUTO_CREATE: set[str] = set()
+
+logger = get_logger(__name__)
+
 
 class UMSAgentGateway:
 
-    def __init__(self, ums_agent_endpoint: str):
+    def __init__(self, ums_agent_endpoint: str, client: httpx.AsyncClient):
         self.ums_agent_endpoint = ums_agent_endpoint
+        self._client = client
 
     async def response(
             self,
             choice: Choice,
             stage: Stage,
             request: Request,
-            additional_instructions: Optional[str]
+            additional_instructions: Optional[str],
+            conversation_id: Optional[str] = None
     ) -> Message:
-        # Get UMS conversation id
-        conversation_id = self.__get_ums_conversation_id(request)
-        
-        # If no conversation id found, create new conversation
+        # Get UMS conversation id (it can be already resolved by the caller)
+        history_conversation_id = self.__get_ums_conversation_id(request)
         if not conversation_id:
-            conversation_id = await self.__create_ums_conversation()
-            # Set conversation id to choice state
-            choice.set_state({_UMS_CONVERSATION_ID: conversation_id})
+            conversation_id = history_conversation_id or await self.__new_conversation_id()
+        is_new_conversation = conversation_id != history_conversation_id
         
         # Get last message (user message) and augment with additional instructions
         last_message = request.messages[-1]
@@ -37,16 +45,34 @@ class UMSAgentGateway:
         if additional_instructions:
             user_message = f"{user_message}\n\nAdditional instructions: {additional_instructions}"
         
-        # Call UMS Agent
-        content = await self.__call_ums_agent(conversation_id, user_message, choice)
+        # Call UMS Agent, new conversations are created by the first chat call where the backend allows it
+        content = await self.__call_ums_agent(conversation_id, user_message, choice, allow_missing=is_new_conversation)
+        if content is None:
+            logger.info("UMS agent %s doesn't auto-create conversations, creating it explicitly", self.ums_agent_endpoint)
+            _NO_AUTO_CREATE.add(self.ums_agent_endpoint)
+            conversation_id = await self.__create_ums_conversation()
+            content = await self.__call_ums_agent(conversation_id, user_message, choice)
+        
+        # If conversation was created within this request, set conversation id to choice state
+        if is_new_conversation:
+            choice.set_state({_UMS_CONVERSATION_ID: conversation_id})
         
         # Return assistant message
         return Message(role=Role.ASSISTANT, content=content)
 
+    async def resolve_conversation_id(self, request: Request) -> str:
+        """Get UMS conversation ID from previous messages or start a new conversation"""
+        return self.__get_ums_conversation_id(request) or await self.__new_conversation_id()
+
+    async def __new_conversation_id(self) -> str:
+        """Generate conversation id on our side, so the first chat call creates it without extra round-trip"""
+        if self.ums_agent_endpoint in _NO_AUTO_CREATE:
+            return await self.__create_ums_conversation()
+        return str(uuid.uuid4())
 
     def __get_ums_conversation_id(self, request: Request) -> Optional[str]:
-        """Extract UMS conversation ID from previous messages if it exists"""
-        for message in request.messages:
+        """Extract UMS conversation ID from previous messages if it exists, the most recent one wins"""
+        for message in reversed(request.messages):
             if message.role == Role.ASSISTANT and message.custom_content:
                 state = message.custom_content.state
                 if state and isinstance(state, dict) and _UMS_CONVERSATION_ID in state:
@@ -55,101 +81,119 @@ class UMSAgentGateway:
 
     async def __create_ums_conversation(self) -> str:
         """Create a new conversation on UMS agent side"""
-        async with httpx.AsyncClient() as client:
+        try:
+            # Try with empty JSON body
+            response = await self._client.post(
+                f"{self.ums_agent_endpoint}/conversations",
+                content=b"{}",
+                headers={"Content-Type": "application/json"},
+                timeout=30.0
+            )
+            response.raise_for_status()
+            result = response.json()
+            return result["id"]
+        except httpx.HTTPStatusError as e:
+            error_detail = ""
             try:
-                # Try with empty JSON body
-                response = await client.post(
-                    f"{self.ums_agent_endpoint}/conversations",
-                    json={},
-                    headers={"Content-Type": "application/json"},
-                    timeout=30.0
-                )
-                response.raise_for_status()
-                result = response.json()
-                return result["id"]
-            except httpx.HTTPStatusError as e:
-                import logging
-                logger = logging.getLogger(__name__)
-                error_detail = ""
-                try:
-                    error_detail = e.response.json()
-                except:
-                    error_detail = e.response.text
-                logger.error(f"Failed to create UMS conversation: {e.response.status_code}")
-                logger.error(f"Error details: {error_detail}")
-                logger.error(f"Request URL: {e.request.url}")
-                # If conversation creation fails, we can still proceed without it
-                # Generate a temporary conversation ID
-                import uuid
-                temp_id = str(uuid.uuid4())
-                logger.warning(f"Using temporary conversation ID: {temp_id}")
-                return temp_id
+                error_detail = e.response.json()
+            except:
+                error_detail = e.response.text
+            logger.error("Failed to create UMS conversation: %s", e.response.status_code)
+            logger.error("Error details: %s", error_detail)
+            logger.error("Request URL: %s", e.request.url)
+            # If conversation creation fails, we can still proceed without it
+            # Generate a temporary conversation ID
+            temp_id = str(uuid.uuid4())
+            logger.warning("Using temporary conversation ID: %s", temp_id)
+            return temp_id
 
     async def __call_ums_agent(
             self,
             conversation_id: str,
             user_message: str,
-            choice: Choice
-    ) -> str:
-        """Call UMS agent and stream the response"""
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
+            choice: Choice,
+            allow_missing: bool = False
+    ) -> Optional[str]:
+        """Call UMS agent and stream the response, returns None if conversation doesn't exist and allow_missing is set"""
+        async with self._client.stream(
+                "POST",
                 f"{self.ums_agent_endpoint}/conversations/{conversation_id}/chat",
-                json={
+                content=orjson.dumps({
                     "message": {
                         "role": "user",
                         "content": user_message
                     },
                     "stream": True
-                },
+                }),
                 headers={"Content-Type": "application/json"},
                 timeout=300.0
-            )
+        ) as response:
+            if allow_missing and response.status_code == 404:
+                return None
             response.raise_for_status()
             
             content = ""
             chunk_count = 0
-            async for line in response.aiter_lines():
-                if not line.strip():
-                    continue
+            async with ChoiceWriter(choice) as writer:
+                async for data_bytes in _aiter_data(response):
+                    # Check for [DONE]
+                    if data_bytes == b"[DONE]":
+                        break
                 
-                # Remove "data: " prefix
-                if line.startswith("data: "):
-                    data_str = line[6:]
-                else:
-                    data_str = line
-                
-                # Check for [DONE]
-                if data_str.strip() == "[DONE]":
-                    break
-                
-                try:
-                    data = json.loads(data_str)
+                    try:
+                        data = orjson.loads(data_bytes)
                     
-                    # Handle conversation_id in response
-                    if "conversation_id" in data:
-                        continue
+                        # Handle conversation_id in response
+                        if "conversation_id" in data:
+                            continue
                     
-                    # Extract content from choices
-                    if "choices" in data and len(data["choices"]) > 0:
-                        delta = data["choices"][0].get("delta", {})
-                        if "content" in delta:
-                            chunk = delta["content"]
-                            content += chunk
-                            chunk_count += 1
-                            # Append to choice - this is the correct way to write content in DIAL SDK
-                            try:
-                                choice.append_content(chunk)
-                            except Exception as e:
-                                import logging
-                                logger = logging.getLogger(__name__)
-                                logger.warning(f"Could not append to choice: {e}")
-                except json.JSONDecodeError:
-                    continue
-            
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.info(f"UMS response collected - Total chunks: {chunk_count}, Content length: {len(content)}")
-            logger.info(f"UMS response content preview: {content[:200] if content else 'None'}...")
-            
-            return content
\ No newline at end of file
+                        # Extract content from choices
+                        if "choices" in data and len(data["choices"]) > 0:
+                            delta = data["choices"][0].get("delta", {})
+                            if "content" in delta:
+                                chunk = delta["content"]
+                                content += chunk
+                                chunk_count += 1
+                                # Append to choice through writer, it coalesces small deltas into bigger chunks
+                                writer.write(chunk)
+                    except orjson.JSONDecodeError:
+                        continue
+        
+        logger.info("UMS response collected - Total chunks: %d, Content length: %d", chunk_count, len(content))
+        logger.debug("UMS response content preview: %.200s...", content)
+        
+        return content
+
+
+# SSE fields that carry no payload, comment lines start with ":"
+_SSE_SKIPPED_PREFIXES = (b"event:", b"id:", b"retry:", b":")
+
+
+async def _aiter_data(response: httpx.Response) -> AsyncIterator[bytes]:
+    """
+    Split streamed SSE body into payloads without decoding it to str. Lines are split on LF (CRLF tolerated), every
+    `data:` line is a payload, lines without prefix (plain JSON lines) are passed as is, other SSE fields are skipped
+    """
+    buffer = bytearray()
+    async for raw in response.aiter_bytes():
+        buffer += raw
+        start = 0
+        lines = []
+        while (end := buffer.find(b"\n", start)) != -1:
+            lines.append(bytes(buffer[start:end]))
+            start = end + 1
+        del buffer[:start]
+        for line in lines:
+            if (payload := _line_payload(line)) is not None:
+                yield payload
+    if (payload := _line_payload(bytes(buffer))) is not None:
+        yield payload
+
+
+def _line_payload(line: bytes) -> Optional[bytes]:
+    line = line.strip()
+    if not line or line.startswith(_SSE_SKIPPED_PREFIXES):
+        return None
+    if line.startswith(b"data:"):
+        return line[5:].lstrip() or None
+    return line
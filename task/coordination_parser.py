@@ -0,0 +1,72 @@
+import asyncio
+from typing import Optional
+
+from task.models import CoordinationRequest, AgentName
+
+
+class CoordinationStreamParser:
+    """
+    Incremental parser for streamed coordination request JSON.
+
+    Content deltas are fed as they arrive, `agent_name` future is resolved as soon as the top-level
+    `agent_name` string is complete, the rest of the content (additional instructions) keeps buffering
+    and is validated with `result()` when the stream is finished.
+    """
+
+    def __init__(self):
+        self.agent_name: asyncio.Future[AgentName] = asyncio.get_running_loop().create_future()
+        self._chunks: list[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._after_colon = False
+        self._key: Optional[str] = None
+        self._string: list[str] = []
+
+    def feed(self, content: str) -> None:
+        self._chunks.append(content)
+        if self.agent_name.done():
+            return
+        for char in content:
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                    self._string.append(char)
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self.__on_string(''.join(self._string))
+                else:
+                    self._string.append(char)
+            elif char == '"':
+                self._in_string = True
+                self._string = []
+            elif char in '{[':
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+            elif self._depth == 1 and char == ':':
+                self._after_colon = True
+            elif self._depth == 1 and char == ',':
+                self._after_colon = False
+
+    def __on_string(self, value: str) -> None:
+        if not self._after_colon:
+            self._key = value
+            return
+        self._after_colon = False
+        if self._key == 'agent_name' and value in AgentName.__members__ and not self.agent_name.done():
+            self.agent_name.set_result(AgentName(value))
+
+    @property
+    def content(self) -> str:
+        return ''.join(self._chunks)
+
+    def result(self) -> CoordinationRequest:
+        """Validate full streamed content as coordination request"""
+        coordination_request = CoordinationRequest.model_validate_json(self.content)
+        if not self.agent_name.done():
+            self.agent_name.set_result(coordination_request.agent_name)
+        return coordination_request
@@ -1,68 +1,260 @@
-COORDINATION_REQUEST_SYSTEM_PROMPT = """
-You are a Multi Agent System (MAS) coordination assistant. Your role is to analyze user requests and determine which specialized agent should handle each request.
-
-## Available Agents:
-
-1. **GPA (General-purpose Agent)**: 
-   - Handles general tasks and answers user questions
-   - Provides WEB search capabilities (DuckDuckGo via MCP)
-   - Performs RAG search through documents (supports PDF, TXT, CSV files)
-   - Retrieves content from documents
-   - Performs calculations with Python Code Interpreter
-   - Use this agent for general questions, web searches, document analysis, calculations, and non-user-management tasks
-
-2. **UMS (Users Management Service Agent)**:
-   - Manages users within the Users Management Service
-   - Handles user-related queries (checking if users exist, adding users, updating user information, etc.)
-   - Use this agent for any requests related to user management, user data, or user operations
-
-## Your Task:
-
-Analyze the user's request and determine:
-1. Which agent (GPA or UMS) should handle this request
-2. Any additional instructions that should be provided to the selected agent to better fulfill the request
-
-## Instructions:
-
-- Carefully read and understand the user's request
-- Identify the primary intent and domain of the request
-- Select the most appropriate agent based on the request type
-- If the request involves user management, user data, or user operations, route to UMS
-- For all other requests (general questions, searches, document analysis, calculations), route to GPA
-- Provide clear, concise additional instructions if needed to help the agent better understand or fulfill the request
+import functools
+import hashlib
+import json
+import sys
+import textwrap
+import unicodedata
+import warnings
+from typing import Any, Callable, Optional
+
+from task.models import CoordinationRequest
+
+try:
+    import tiktoken
+except ImportError:  # optional, token counts are estimated without it
+    tiktoken = None
+
+
+def _canonicalize(raw: str) -> str:
+    """Normalize prompt text once at import, so every request sends byte-identical prefix"""
+    text = "\n".join(line.rstrip() for line in textwrap.dedent(raw).strip().splitlines())
+    return sys.intern(unicodedata.normalize("NFC", text) + "\n")
+
+
+# Section scaffolding shared by both prompts, defined once and assembled into the prompts at import
+_TASK_HEADER = "## Your Task:"
+
+_INSTRUCTIONS_HEADER = "## Instructions:"
+
+_INSTRUCTIONS_FOOTER_COORD = f"""{_INSTRUCTIONS_HEADER}
+
+- Identify the primary intent of the request
+- User management, user data or user operations -> UMS
+- Everything else (general questions, web search, document analysis, calculations) -> GPA
+- Add short additional instructions only when they help the agent
 - Return your decision in the specified JSON format
 """
 
+_INSTRUCTIONS_FOOTER_FINAL = f"""{_INSTRUCTIONS_HEADER}
 
-FINAL_RESPONSE_SYSTEM_PROMPT = """
-You are a Multi Agent System (MAS) finalization assistant. Your role is to synthesize and present the final response to the user based on the work performed by specialized agents.
+- Use only information provided by the agent, never invent details
+- Be clear, direct, complete and conversational
+"""
 
-## Context:
 
-You are working in the finalization step of a multi-agent system. A specialized agent has already processed the user's request and provided a response. Your task is to:
+# Agent catalog goes first as its own block, it changes least often and is cached longest.
+# Plain literal on purpose, no interpolation can change its bytes
+_RAW_AGENT_MANIFEST = """
+## AGENT_MANIFEST:
 
-1. Review the agent's response in the context of the original user request
-2. Ensure the response is clear, complete, and directly addresses the user's question
-3. Present the information in a natural, conversational manner
-4. Maintain the accuracy and completeness of the agent's work
+AGENT|HANDLES|ROUTE_WHEN
+GPA|general Q&A, web search (DuckDuckGo via MCP), RAG over docs (PDF/TXT/CSV), Python calculations|general questions, search, math, documents
+UMS|Users Management Service: user search, create, update, delete|anything about users or user data
+"""
 
-## Your Task:
 
-You will receive:
-- The original user request
-- The response from the specialized agent (as context)
+_RAW_COORDINATION = f"""
+You are a Multi Agent System (MAS) coordinator. Route each user request to the right specialized agent.
+See AGENT_MANIFEST above.
 
-Your job is to:
-- Synthesize the agent's response into a clear, user-friendly final answer
-- Ensure the response directly addresses the user's original question
-- Present the information naturally without unnecessary repetition
-- If the agent's response is already clear and complete, you may present it as-is or with minor refinements
+{_TASK_HEADER}
 
-## Instructions:
+Decide:
+1. Which agent (GPA or UMS) handles the request
+2. Additional instructions for that agent, if any
 
-- Do not add information that wasn't provided by the agent
-- Do not make up or invent details
-- Focus on clarity and directness
-- Ensure the response is helpful and complete
-- Maintain a conversational, friendly tone
-"""
+{_INSTRUCTIONS_FOOTER_COORD}"""
+
+
+_RAW_FINAL_RESPONSE = f"""
+You are a Multi Agent System (MAS) finalization assistant. A specialized agent already processed the user's request; present its result as the final answer.
+
+{_TASK_HEADER}
+
+You receive the original user request and the agent's response as context.
+- Turn the agent's response into a clear final answer to the original question
+- Avoid repetition; if the response is already clear and complete, keep it as-is or refine slightly
+- Preserve the accuracy and completeness of the agent's work
+
+{_INSTRUCTIONS_FOOTER_FINAL}"""
+
+
+# Fixed routing examples, rendered once into the coordination prefix. Besides steering the classifier they keep
+# the static prefix above the ~1024 tokens providers require before prompt caching kicks in
+_ROUTING_FEW_SHOTS: tuple[tuple[str, str, Optional[str]], ...] = (
+    ("Is there a user with email john.smith@example.com?", "UMS", "Search users by email john.smith@example.com"),
+    ("Add a new user Anna Kowalska, anna.k@example.com, born 1990-04-12", "UMS", "Create user with provided name, email and birth date"),
+    ("Change the phone number of user 42 to +48 600 100 200", "UMS", "Update phone number of the user with id 42"),
+    ("Delete all users named Test", "UMS", "Find users with name Test and delete each of them"),
+    ("How many users are registered in the system?", "UMS", None),
+    ("Show me users with gender female and surname Brown", "UMS", "Search users filtering by gender and surname"),
+    ("What's the weather in Kyiv tomorrow?", "GPA", "Use web search to find tomorrow's forecast for Kyiv"),
+    ("Summarize the attached PDF", "GPA", "Summarize the attached document"),
+    ("Calculate compound interest on 10000 at 5% for 7 years", "GPA", "Use Python Code Interpreter for calculation"),
+    ("Who won the latest Champions League final?", "GPA", "Use web search, the answer depends on recent events"),
+    ("Plot sales by month from the attached CSV", "GPA", "Load the CSV and build the chart with Python Code Interpreter"),
+    ("Explain the difference between TCP and UDP", "GPA", None),
+    ("Translate this paragraph into German: Good morning, team", "GPA", None),
+    ("Find in the document what the refund policy says", "GPA", "Use RAG search over the attached document"),
+    ("Generate a picture of a cat wearing a hat", "GPA", None),
+    ("Check if user Bob exists and if not, add him with email bob@example.com", "UMS", "Search user Bob first, create him only if not found"),
+    ("List users older than 60 years", "UMS", "Search users and filter them by birth date"),
+    ("Update address of Maria Garcia to 12 Main St, Springfield", "UMS", "Find user Maria Garcia and update her address"),
+    ("Search the web for the latest Python release and its main features", "GPA", "Use web search, summarize key features"),
+    ("What is 17% of 2345.50?", "GPA", "Use Python Code Interpreter for calculation"),
+    ("Remove user with email old.account@example.com", "UMS", "Find user by email and delete it"),
+    ("Does anyone named Olena Shevchenko work here? Add her if she is missing", "UMS", "Search user Olena Shevchenko, create her only if not found"),
+    ("Compare the two attached reports and list the key differences", "GPA", "Use RAG search over both attached documents"),
+    ("Find recent news about the EU AI Act and summarize them", "GPA", "Use web search, summarize the most recent news"),
+)
+
+
+def _render_routing_few_shots() -> str:
+    lines = ["## Examples:", ""]
+    for user_request, agent_name, additional_instructions in _ROUTING_FEW_SHOTS:
+        decision = json.dumps({"agent_name": agent_name, "additional_instructions": additional_instructions})
+        lines.append(f"User request: {user_request}")
+        lines.append(f"Decision: {decision}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+FINAL_RESPONSE_SUFFIX_TEMPLATE = "Context from agent:\n{agent_response}\n\nUser request: {request}"
+
+
+def _render_response_schema() -> str:
+    # Same schema as sent in response_format. Model field order is kept (and is deterministic), so agent_name
+    # comes first and the stream parser can dispatch before additional instructions are generated
+    schema = json.dumps(CoordinationRequest.model_json_schema(), separators=(",", ":"))
+    return f"## Response JSON Schema:\n\n{schema}\n"
+
+
+class PerformanceWarning(Warning):
+    """Change that silently degrades performance, e.g. resets provider prompt cache"""
+
+
+# SHA-256 of the static prefixes, bump them deliberately together with any prompt change
+_HASH_PINS = {
+    "COORDINATION_PREFIX": "8994329e313682d1c15aa348ecf70480e3fd2fae37659a64f896b7a24bf042fa",
+    "FINAL_RESPONSE_PREFIX": "9ec51972bf0f6ff96b049f7f9b292e728650d8e88fe9ce5c77a5537bfb8839e0",
+}
+
+
+def _check_pin(name: str, prompt: str) -> str:
+    digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    if digest != _HASH_PINS[name]:
+        warnings.warn(
+            f"{name} changed (sha256 {digest}), provider prefix cache will reset. Update the pin if intended",
+            PerformanceWarning,
+            stacklevel=2
+        )
+    return prompt
+
+
+# Static prefixes go first and never change between requests, everything request specific goes after them.
+# Prompts are built on first access (PEP 562), so a process pays only for the prompts it actually uses
+_BUILDERS: dict[str, Callable[[], Any]] = {
+    "AGENT_MANIFEST": lambda: _canonicalize(_RAW_AGENT_MANIFEST),
+    "_COORDINATION_INSTRUCTIONS": lambda: _canonicalize(
+        _RAW_COORDINATION + "\n" + _render_routing_few_shots() + "\n" + _render_response_schema()
+    ),
+    "COORDINATION_PREFIX": lambda: _check_pin(
+        "COORDINATION_PREFIX",
+        sys.intern(_get("AGENT_MANIFEST") + "\n" + _get("_COORDINATION_INSTRUCTIONS"))
+    ),
+    "FINAL_RESPONSE_PREFIX": lambda: _check_pin("FINAL_RESPONSE_PREFIX", _canonicalize(_RAW_FINAL_RESPONSE)),
+    "COORDINATION_REQUEST_SYSTEM_PROMPT": lambda: _get("COORDINATION_PREFIX"),
+    "FINAL_RESPONSE_SYSTEM_PROMPT": lambda: _get("FINAL_RESPONSE_PREFIX"),
+    # UTF-8 encoded prefixes, encoded once for hashing and byte level request building
+    "COORDINATION_PREFIX_BYTES": lambda: _get("COORDINATION_PREFIX").encode("utf-8"),
+    "FINAL_RESPONSE_PREFIX_BYTES": lambda: _get("FINAL_RESPONSE_PREFIX").encode("utf-8"),
+    "COORDINATION_REQUEST_SYSTEM_PROMPT_BYTES": lambda: _get("COORDINATION_PREFIX_BYTES"),
+    "FINAL_RESPONSE_SYSTEM_PROMPT_BYTES": lambda: _get("FINAL_RESPONSE_PREFIX_BYTES"),
+    # Stable prompt identity, pass it as `prompt_cache_key` (Fireworks `x-session-affinity`) so requests
+    # with the same prefix are routed to the same replica and hit its prompt cache
+    "COORDINATION_AFFINITY": lambda: hashlib.blake2b(_get("COORDINATION_PREFIX_BYTES"), digest_size=8).hexdigest(),
+    "FINAL_AFFINITY": lambda: hashlib.blake2b(_get("FINAL_RESPONSE_PREFIX_BYTES"), digest_size=8).hexdigest(),
+}
+
+
+def __getattr__(name: str) -> Any:
+    builder = _BUILDERS.get(name)
+    if builder is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    # Cache on module, next lookups don't reach __getattr__
+    value = globals()[name] = builder()
+    return value
+
+
+def _get(name: str) -> Any:
+    """Lazy prompt constant for use inside this module (module __getattr__ doesn't apply to global lookups)"""
+    return globals()[name] if name in globals() else __getattr__(name)
+
+
+def _text_block(text: str, ttl: str) -> dict[str, Any]:
+    return {"type": "text", "text": text, "cache_control": {"type": "ephemeral", "ttl": ttl}}
+
+
+def coordination_system_block(ttl: str = "5m") -> list[dict[str, Any]]:
+    """
+    Coordination prefix as content blocks with cache markers (required by Anthropic models to cache the prefix).
+    Agent manifest is a separate block cached for 1h, the instructions after it for `ttl`.
+    """
+    return [
+        _text_block(_get("AGENT_MANIFEST"), "1h"),
+        _text_block("\n" + _get("_COORDINATION_INSTRUCTIONS"), ttl)
+    ]
+
+
+def final_response_system_block(ttl: str = "5m") -> list[dict[str, Any]]:
+    """Finalization prefix as content block with cache marker (required by Anthropic models to cache the prefix)"""
+    return [_text_block(_get("FINAL_RESPONSE_PREFIX"), ttl)]
+
+
+def build_coordination_messages(messages: list[dict[str, Any]], cache_control: bool = False) -> list[dict[str, Any]]:
+    """Static coordination prefix followed by the conversation messages"""
+    system = coordination_system_block() if cache_control else _get("COORDINATION_PREFIX")
+    return [{"role": "system", "content": system}, *messages]
+
+
+def build_final_response_messages(
+        messages: list[dict[str, Any]],
+        agent_response: Optional[str],
+        cache_control: bool = False
+) -> list[dict[str, Any]]:
+    """Static finalization prefix followed by the conversation, the last user message is augmented with agent response"""
+    *history, last_message = messages
+    suffix = FINAL_RESPONSE_SUFFIX_TEMPLATE.format(agent_response=agent_response, request=last_message.get("content"))
+    system = final_response_system_block() if cache_control else _get("FINAL_RESPONSE_PREFIX")
+    return [
+        {"role": "system", "content": system},
+        *history,
+        {**last_message, "content": suffix}
+    ]
+
+
+_PREFIXES = {
+    "coordination": "COORDINATION_PREFIX",
+    "final_response": "FINAL_RESPONSE_PREFIX",
+}
+
+
+@functools.cache
+def _encoding():
+    # o200k_base is the encoding of gpt-4o (default deployment)
+    return tiktoken.get_encoding("o200k_base") if tiktoken else None
+
+
+@functools.cache
+def prefix_tokens(name: str) -> tuple[int, ...]:
+    """Tokenized static prefix ('coordination' or 'final_response'), empty if tiktoken is not installed"""
+    encoding = _encoding()
+    return tuple(encoding.encode(_get(_PREFIXES[name]))) if encoding else ()
+
+
+@functools.cache
+def prefix_token_count(name: str) -> int:
+    """Token count of static prefix, estimated as 4 chars per token if tiktoken is not installed"""
+    if _encoding():
+        return len(prefix_tokens(name))
+    return len(_get(_PREFIXES[name])) // 4
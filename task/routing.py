@@ -0,0 +1,26 @@
+import hashlib
+import random
+from typing import Optional
+
+
+def parse_endpoints(value: str) -> list[str]:
+    """Parse comma-separated list of endpoints"""
+    return [endpoint.strip() for endpoint in value.split(',') if endpoint.strip()]
+
+
+def pick_endpoint(conversation_id: Optional[str], endpoints: list[str]) -> str:
+    """
+    Pick agent endpoint for the conversation with rendezvous hashing.
+
+    The same conversation always lands on the same endpoint (while it's in the list), so backend-side
+    caches stay warm, and conversations are spread evenly between endpoints. Requests without
+    conversation id go to a random endpoint.
+    """
+    if len(endpoints) == 1:
+        return endpoints[0]
+    if not conversation_id:
+        return random.choice(endpoints)
+    return max(
+        endpoints,
+        key=lambda endpoint: hashlib.blake2b(f"{conversation_id}|{endpoint}".encode(), digest_size=8).digest()
+    )
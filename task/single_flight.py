@@ -0,0 +1,45 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from task.coordination_parser import CoordinationStreamParser
+from task.models import CoordinationRequest
+
+
+@dataclass
+class CoordinationFlight:
+    """Classifier call shared by all callers with the same key"""
+    parser: CoordinationStreamParser
+    task: asyncio.Task[CoordinationRequest]
+
+
+class SingleFlight:
+    """
+    Single-flight deduplication of classifier calls: concurrent callers with the same key share one upstream call
+    (requests with different keys are never combined). Also bounds the number of upstream calls running at once.
+    """
+
+    def __init__(self, max_concurrency: int = 32):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._in_flight: dict[str, CoordinationFlight] = {}
+
+    def submit(
+            self,
+            key: str,
+            call: Callable[[CoordinationStreamParser], Awaitable[CoordinationRequest]]
+    ) -> CoordinationFlight:
+        flight = self._in_flight.get(key)
+        if flight is None:
+            parser = CoordinationStreamParser()
+            flight = CoordinationFlight(parser=parser, task=asyncio.create_task(self.__run(call, parser)))
+            self._in_flight[key] = flight
+            flight.task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return flight
+
+    async def __run(
+            self,
+            call: Callable[[CoordinationStreamParser], Awaitable[CoordinationRequest]],
+            parser: CoordinationStreamParser
+    ) -> CoordinationRequest:
+        async with self._semaphore:
+            return await call(parser)
@@ -0,0 +1,51 @@
+import json
+import unittest
+
+from pydantic import ValidationError
+
+from task.coordination_parser import CoordinationStreamParser
+from task.models import AgentName
+
+
+class CoordinationStreamParserTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_char_by_char_deltas(self):
+        content = '{"agent_name": "UMS", "additional_instructions": "Find user"}'
+        parser = CoordinationStreamParser()
+        for index, char in enumerate(content):
+            parser.feed(char)
+            # Resolved exactly when the agent name string closes
+            self.assertEqual(parser.agent_name.done(), index >= content.index('"UMS"') + 4)
+        self.assertEqual(parser.agent_name.result(), AgentName.UMS)
+        self.assertEqual(parser.result().additional_instructions, "Find user")
+
+    async def test_instructions_before_agent_name(self):
+        parser = CoordinationStreamParser()
+        parser.feed('{"additional_instructions": "Set \\"agent_name\\": \\"UMS\\" ')
+        parser.feed('and \\"agent_name\\", \\"GPA\\"", ')
+        self.assertFalse(parser.agent_name.done())
+        parser.feed('"agent_name": "GPA"}')
+        self.assertEqual(parser.agent_name.result(), AgentName.GPA)
+        self.assertEqual(
+            parser.result().additional_instructions, 'Set "agent_name": "UMS" and "agent_name", "GPA"'
+        )
+
+    async def test_escaped_quotes(self):
+        content = json.dumps({"additional_instructions": 'Say "hi" \\ "bye"', "agent_name": "GPA"})
+        parser = CoordinationStreamParser()
+        for start in range(0, len(content), 3):
+            parser.feed(content[start:start + 3])
+        self.assertEqual(parser.agent_name.result(), AgentName.GPA)
+        self.assertEqual(parser.result().additional_instructions, 'Say "hi" \\ "bye"')
+
+    async def test_non_member_agent_name(self):
+        parser = CoordinationStreamParser()
+        parser.feed('{"agent_name": "gpa", "additional_instructions": null}')
+        self.assertFalse(parser.agent_name.done())
+        with self.assertRaises(ValidationError):
+            parser.result()
+        self.assertFalse(parser.agent_name.done())
+
+
+if __name__ == "__main__":
+    unittest.main()
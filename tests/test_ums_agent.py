@@ -0,0 +1,107 @@
+import unittest
+
+import httpx
+from aidial_sdk.chat_completion import Message, Request, Role
+
+from task.coordination import ums_agent
+from task.coordination.ums_agent import UMSAgentGateway
+
+
+class _RecordingChoice:
+
+    def __init__(self):
+        self.content = ""
+        self.state = None
+
+    def append_content(self, content: str) -> None:
+        self.content += content
+
+    def set_state(self, state: dict) -> None:
+        self.state = state
+
+
+def _chunk(content: str) -> str:
+    return '{"choices": [{"delta": {"content": "%s"}}]}' % content
+
+
+def _request() -> Request:
+    return Request.construct(messages=[Message(role=Role.USER, content="Do we have Andrej?")])
+
+
+class UMSAgentStreamTest(unittest.IsolatedAsyncioTestCase):
+
+    async def _response(self, body: bytes) -> tuple[str, str]:
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, content=body))
+        async with httpx.AsyncClient(transport=transport) as client:
+            gateway = UMSAgentGateway("http://ums", client)
+            choice = _RecordingChoice()
+            message = await gateway.response(choice, None, _request(), None, conversation_id="conv-1")
+        return message.content, choice.content
+
+    async def test_lf_framed_events(self):
+        body = f"data: {_chunk('Hi ')}\n\ndata: {_chunk('there')}\n\ndata: [DONE]\n\n".encode()
+        self.assertEqual(await self._response(body), ("Hi there", "Hi there"))
+
+    async def test_crlf_framed_events(self):
+        body = f"data: {_chunk('Hi ')}\r\n\r\ndata: {_chunk('there')}\r\n\r\ndata: [DONE]\r\n\r\n".encode()
+        self.assertEqual(await self._response(body), ("Hi there", "Hi there"))
+
+    async def test_plain_json_lines(self):
+        body = f'{{"conversation_id": "conv-1"}}\n{_chunk("Hi ")}\ndata: {_chunk("there")}\n'.encode()
+        self.assertEqual(await self._response(body), ("Hi there", "Hi there"))
+
+    async def test_events_with_extra_fields(self):
+        body = (
+            f": keep-alive\n\nevent: message\nid: 1\ndata: {_chunk('Hi ')}\n\n"
+            f"event: message\nid: 2\ndata: {_chunk('there')}\n\ndata: [DONE]\n\n"
+        ).encode()
+        self.assertEqual(await self._response(body), ("Hi there", "Hi there"))
+
+
+class UMSAgentConversationTest(unittest.IsolatedAsyncioTestCase):
+    """Backend without conversation auto-creation: chat on unknown id is 404, conversation must be created first"""
+
+    def setUp(self):
+        ums_agent._NO_AUTO_CREATE.clear()
+        self.calls: list[tuple[str, str]] = []
+        self.created: set[str] = set()
+
+    def tearDown(self):
+        ums_agent._NO_AUTO_CREATE.clear()
+
+    def _handle(self, request: httpx.Request) -> httpx.Response:
+        self.calls.append((request.method, request.url.path))
+        if request.url.path == "/conversations":
+            conversation_id = f"created-{len(self.created) + 1}"
+            self.created.add(conversation_id)
+            return httpx.Response(200, json={"id": conversation_id})
+        if request.url.path.split("/")[2] not in self.created:
+            return httpx.Response(404, json={"detail": "Conversation not found"})
+        return httpx.Response(200, content=f"data: {_chunk('Hi')}\n\ndata: [DONE]\n\n".encode())
+
+    async def _response(self, gateway: UMSAgentGateway) -> tuple[str, _RecordingChoice]:
+        choice = _RecordingChoice()
+        message = await gateway.response(choice, None, _request(), None)
+        return message.content, choice
+
+    async def test_falls_back_to_explicit_create_on_404(self):
+        async with httpx.AsyncClient(transport=httpx.MockTransport(self._handle)) as client:
+            gateway = UMSAgentGateway("http://ums", client)
+            content, choice = await self._response(gateway)
+            self.assertEqual(content, "Hi")
+            self.assertEqual(choice.state, {"ums_conversation_id": "created-1"})
+            self.assertEqual([call for call in self.calls if call[1] == "/conversations"], [("POST", "/conversations")])
+            self.assertEqual(self.calls[-1], ("POST", "/conversations/created-1/chat"))
+            self.assertEqual(len(self.calls), 3)
+            self.assertIn("http://ums", ums_agent._NO_AUTO_CREATE)
+
+            # Endpoint is remembered, the next new conversation is created up front
+            self.calls.clear()
+            content, choice = await self._response(gateway)
+            self.assertEqual(content, "Hi")
+            self.assertEqual(choice.state, {"ums_conversation_id": "created-2"})
+            self.assertEqual(self.calls, [("POST", "/conversations"), ("POST", "/conversations/created-2/chat")])
+
+
+if __name__ == "__main__":
+    unittest.main()